@@ -51,12 +51,17 @@ setup(
     packages=[''],
     package_data={'': ['main.ui', '.version']},
     include_package_data=True,
-    py_modules=["sox_noise"],
+    py_modules=["sox_noise", "sox_noise_numpy", "sox_noise_bench"],
     install_requires=['wheel', 'PyGObject'],
+    extras_require={'numpy': ['numpy']},
     entry_points={
         'gui_scripts': [
             'sox-noise=sox_noise:start',
         ],
+        'console_scripts': [
+            'sox-noise-headless=sox_noise:headless',
+            'sox-noise-batch=sox_noise:batchRender',
+        ],
     },
     setup_requires=['wheel', 'install_freedesktop>=0.2.0'],
     dependency_links=[
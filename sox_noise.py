@@ -3,53 +3,1065 @@
 # fair-used off of: https://gist.github.com/rsvp/1209835
 
 import os
-import gi
 import sys
+import glob
+import json
+import math
+import time
+import queue
+import shlex
 import signal
+import socket
+import struct
+import fcntl
+import errno
+import hashlib
+import importlib.util
 import argparse
+import tempfile
+import threading
+import socketserver
 import configparser
-gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, GLib, Gdk, Gio, GdkPixbuf
-from subprocess import Popen
+from subprocess import Popen, PIPE, DEVNULL
+from functools import lru_cache
+from collections import deque
+from array import array
 
+# GTK is only imported once a window is needed, see requireGtk()
+gi = Gtk = GLib = Gdk = Gio = GdkPixbuf = None
 
-class SoxNoise:
-    def __init__(self, args=[], app=None):
-        self.builder = Gtk.Builder()
-        self.builder.add_from_file(os.path.join(os.path.dirname(__file__), "main.ui"))
-        self.builder.connect_signals(self)
-        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, self.onDestroy)
+# format of the audio passed between sources and the sink
+RATE = 48000
+CHANNELS = 2
+FRAME = 2 * CHANNELS  # bytes
+RAW = ['-traw', f'-r{RATE}', '-esigned', '-b16', f'-c{CHANNELS}']
+SPEC_WIDTH = 200
+SLIDERS = ['volume', 'band_center', 'band_width', 'lowpass', 'reverb', 'tremolo_speed', 'tremolo_depth']
+CONTROLS = ['noise', *SLIDERS, 'duration', 'fade', 'extras']  # settable over --control
+OUTPUTS = {
+    'pulse':   ['-tpulseaudio'],
+    'alsa':    ['-talsa'],
+    'wav':     ['-twav', '-'],
+    'sox':     ['-tsox', '-'],
+    'default': ['-d'],
+}
 
-        self.window = self.builder.get_object('main-window')
-        self.main_box = self.builder.get_object('main-box')
-        self.play_button = self.builder.get_object('play-button')
-        self.spec_button = self.builder.get_object('spec-button')
-        self.spec_image = self.builder.get_object('spec-image')
-        self.band_center = self.builder.get_object('adj-band-center')
-        self.band_width = self.builder.get_object('adj-band-width')
-        self.tremolo_speed = self.builder.get_object('adj-tremolo-speed')
-        self.tremolo_depth = self.builder.get_object('adj-tremolo-depth')
-        self.effects = self.builder.get_object('effects-expander')
-        self.lowpass = self.builder.get_object('adj-lowpass')
-        self.reverb = self.builder.get_object('adj-reverb')
-        self.volume = self.builder.get_object('adj-volume')
-        self.menu = self.builder.get_object('popover-menu')
-        if app:  self.window.set_application(app)
+
+# Structured JSON-lines events for the hot paths, enabled with --profile
+class Profiler:
+    def __init__(self):
+        self.out = None
+        self.lock = threading.Lock()
+        self.timings = {}  # event: [ms]
+        self.collect = False  # keep timings for summary() even without an output
+
+    def open(self, target):
+        self.out = sys.stderr if target == '-' else open(target, 'a', buffering=1)
+
+    def event(self, name, **fields):
+        if not self.out and not self.collect:  return
+        if 'ms' in fields:
+            fields['ms'] = round(fields['ms'], 3)
+            self.timings.setdefault(name, []).append(fields['ms'])
+        if not self.out:  return
+        line = json.dumps({'time': time.time(), 'event': name, **fields})
+        with self.lock:
+            print(line, file=self.out)
+
+    def since(self, started):
+        return (time.monotonic() - started) * 1000
+
+    def summary(self):
+        for name, times in sorted(self.timings.items()):
+            times = sorted(times)
+            pct = lambda p: times[min(len(times) - 1, int(len(times) * p / 100))]
+            print(f' {name}: n={len(times)} p50={pct(50):.1f}ms p90={pct(90):.1f}ms'
+                  f' p99={pct(99):.1f}ms max={times[-1]:.1f}ms', file=sys.stderr)
+
+profiler = Profiler()
+
+
+# A supervised child process, which may be waiting for a free slot
+class Job:
+    def __init__(self, kind, args, kwargs, on_start):
+        self.kind = kind
+        self.args = args
+        self.kwargs = kwargs
+        self.on_start = on_start
+        self.proc = None
+        self.returncode = None
+        self.done = threading.Event()
+        self.queued = time.monotonic()
+        self.wall = self.cpu = self.rss = None  # seconds, seconds, bytes
+
+    @property
+    def stdin(self):
+        return self.proc.stdin
+
+    @property
+    def stdout(self):
+        return self.proc.stdout
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        if not self.proc:  # still queued
+            self.finish(-signal.SIGKILL)
+        elif not self.done.is_set():  # Popen.kill() would poll and steal the exit status
+            os.kill(self.proc.pid, signal.SIGKILL)
+
+    def finish(self, returncode):
+        self.returncode = returncode
+        if self.proc:  self.proc.returncode = returncode  # reaped here, not by Popen
+        self.done.set()
+
+
+# Owns every sox child: caps how many background jobs run at once,
+# reaps them as they exit and records what each one cost.
+class Supervisor:
+    PRIORITY = ['source', 'sink', 'stitch']  # streaming consumers never wait for a slot
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max(1, max_jobs)
+        self.lock = threading.Lock()
+        self.running = set()
+        self.queue = deque()
+        self.finished = []
+
+    def spawn(self, kind, args, on_start=None, **kwargs):
+        job = Job(kind, args, kwargs, on_start)
+        with self.lock:
+            if kind in self.PRIORITY or self.busy() < self.max_jobs:
+                self.start(job)
+            else:
+                self.queue.append(job)
+        return job
+
+    def busy(self):
+        return sum(1 for job in self.running if job.kind not in self.PRIORITY)
+
+    def start(self, job):
+        started = time.monotonic()
+        job.proc = Popen(job.args, **job.kwargs)
+        job.started = time.monotonic()
+        profiler.event('spawn', kind=job.kind, pid=job.proc.pid, args=job.args,
+                       queued_ms=(started - job.queued) * 1000, ms=profiler.since(started))
+        self.running.add(job)
+        threading.Thread(target=self.reap, args=(job,), daemon=True).start()
+        if job.on_start:  job.on_start(job)
+
+    def reap(self, job):
+        _, status, usage = os.wait4(job.proc.pid, 0)
+        job.wall = time.monotonic() - job.started
+        job.cpu = usage.ru_utime + usage.ru_stime
+        job.rss = usage.ru_maxrss * 1024
+        job.finish(os.waitstatus_to_exitcode(status))
+        profiler.event('exit', kind=job.kind, pid=job.proc.pid, status=job.returncode,
+                       wall=job.wall, cpu=job.cpu, rss=job.rss)
+        print(f' <=== {job.kind} {job.proc.pid}: {job.wall:.2f}s wall, {job.cpu:.2f}s cpu,'
+              f' {job.rss / 2**20:.0f}MB rss, exit {job.returncode}', file=sys.stderr)
+        with self.lock:
+            self.running.discard(job)
+            self.finished.append(job)
+            while self.queue and self.busy() < self.max_jobs:
+                queued = self.queue.popleft()
+                if not queued.done.is_set():  self.start(queued)
+
+    def stats(self):
+        # per kind: count, total wall and cpu time, peak rss
+        stats = {}
+        for job in self.finished:
+            s = stats.setdefault(job.kind, {'jobs': 0, 'wall': 0, 'cpu': 0, 'rss': 0})
+            s['jobs'] += 1
+            s['wall'] += job.wall
+            s['cpu'] += job.cpu
+            s['rss'] = max(s['rss'], job.rss)
+        return stats
+
+    def shutdown(self):
+        with self.lock:
+            jobs = list(self.queue) + list(self.running)
+            self.queue.clear()
+        for job in jobs:
+            job.kill()
+        for job in jobs:
+            job.wait(1)
+
+
+# Content-addressed store of rendered loops, evicted least-recently-played first
+class RenderCache:
+    def __init__(self, location, max_size, spawn):
+        self.location = location
+        self.max_size = max_size
+        self.spawn = spawn
+        self.pending = {}  # key: (Job, tmp filename)
+
+    def key(self, args):
+        return hashlib.sha256('\0'.join(args).encode()).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.location, f'{key}.sox')
+
+    def get(self, args):
+        if not self.max_size:  return None
+        self.collect()
+        path = self.path(self.key(args))
+        if not os.path.exists(path):  return None
+        os.utime(path)  # mark as recently used
+        return path
+
+    def render(self, args, output_args):
+        # output_args renders the same chain into the given file list
+        key = self.key(args)
+        if not self.max_size:  return None
+        if key not in self.pending:
+            os.makedirs(self.location, exist_ok=True)
+            tmp = self.path(key) + '.part'
+            self.pending[key] = (self.spawn('cache', output_args(['-tsox', tmp]), stderr=DEVNULL), tmp)
+        return self.pending[key][0]
+
+    def cancel(self, args):
+        # drops a render whose loop is not wanted anymore
+        pending = self.pending.pop(self.key(args), None)
+        if not pending:  return
+        proc, tmp = pending
+        proc.kill()
+        proc.wait()
+        if os.path.exists(tmp):  os.remove(tmp)
+
+    def collect(self):
+        # move finished renders into place
+        for key, (proc, tmp) in list(self.pending.items()):
+            if proc.poll() is None:  continue
+            del self.pending[key]
+            if proc.returncode == 0:
+                os.replace(tmp, self.path(key))
+            elif os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    def evict(self):
+        if not os.path.isdir(self.location):  return
+        entries, rendering = [], 0
+        pending = {tmp for proc, tmp in self.pending.values()}
+        for name in os.listdir(self.location):
+            path = os.path.join(self.location, name)
+            if not name.endswith(('.sox', '.sox.part')) or path in pending:  continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:  # finished or evicted by another instance
+                continue
+            if name.endswith('.sox'):
+                entries.append((st.st_mtime, st.st_size, name))
+            elif time.time() - st.st_mtime > 60:  # left behind by a render that died
+                os.remove(path)
+            else:  # another instance is still writing it
+                rendering += st.st_size
+        total = rendering + sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:  break
+            os.remove(os.path.join(self.location, name))
+            total -= size
+
+    def close(self):
+        for proc, tmp in self.pending.values():
+            proc.kill()
+            proc.wait()
+            if os.path.exists(tmp):  os.remove(tmp)
+        self.pending = {}
+
+
+# Index of the .sxn presets in the config dir, kept in the cache dir so only
+# files whose mtime changed get parsed again. A thread at idle priority
+# renders the most recently used ones into the RenderCache and fills the
+# spectrogram cache, so switching to them plays right away.
+class PresetLibrary:
+    def __init__(self, location, index, app, warm=3):
+        self.location = location
+        self.index_path = index
+        self.app = app
+        self.warm = warm  # how many recent presets to keep rendered
+        self.index = None  # path: {mtime, hash, settings, layers, used} or {mtime, error, used}, once scanned
+        self.alive = True
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        # the thread does the first scan, else the presets menu or control socket does when used
+        if self.warm:  threading.Thread(target=self.run, daemon=True).start()
+
+    def scan(self):
+        # returns the paths that were added, changed or removed
+        with self.lock:  # the warm thread scans too
+            if self.index is None:
+                try:
+                    with open(self.index_path) as f:
+                        self.index = json.load(f)
+                except (OSError, ValueError):
+                    self.index = {}
+            paths = sorted(glob.glob(os.path.join(self.location, '*.sxn')))
+            changed = [path for path in self.index if path not in paths]
+            for path in changed:  del self.index[path]
+            for path in paths:
+                mtime = os.path.getmtime(path)
+                entry = self.index.get(path)
+                if entry and entry['mtime'] == mtime:  continue
+                try:
+                    pargs = self.app.presetArgs(path)
+                    params = Params.fromArgs(pargs, self.app.parseLayers(path, pargs))
+                except (ValueError, IndexError, configparser.Error) as e:
+                    print('PRESET ERROR:', path, e, file=sys.stderr)
+                    self.index[path] = {'mtime': mtime, 'error': str(e), 'used': 0}  # until it changes
+                    changed.append(path)
+                    continue
+                settings, layers = params.settings(), [layer.settings() for layer in params.layers]
+                digest = hashlib.sha256(json.dumps([settings, layers], sort_keys=True).encode()).hexdigest()[:32]
+                self.index[path] = {'mtime': mtime, 'hash': digest, 'settings': settings, 'layers': layers,
+                                    'used': entry['used'] if entry else 0}
+                changed.append(path)
+            if changed:
+                self.save()
+                self.wake.set()
+            return changed
+
+    def paths(self):
+        with self.lock:
+            return sorted(path for path, entry in self.index.items() if 'error' not in entry)
+
+    def find(self, name):
+        # by path, file name, name without .sxn or 1-based number
+        paths = self.paths()
+        if name.isdigit():
+            return paths[int(name) - 1] if 0 < int(name) <= len(paths) else None
+        for path in paths:
+            if name in self.names(path):  return path
+
+    def error(self, name):
+        # why a preset find() skips can't be used
+        with self.lock:
+            for path, entry in self.index.items():
+                if 'error' in entry and name in self.names(path):  return entry['error']
+
+    def names(self, path):
+        return [path, os.path.basename(path), os.path.splitext(os.path.basename(path))[0]]
+
+    def use(self, path):
+        with self.lock:
+            entry = self.index[path]
+            entry['used'] = time.time()
+            self.save()
+        self.wake.set()
+        return entry
+
+    def recent(self):
+        entries = [entry for entry in list(self.index.values()) if entry['used']]
+        return sorted(entries, key=lambda entry: -entry['used'])[:self.warm]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path + '.part', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.part', self.index_path)
+
+    def run(self):
+        try:  # nice is per thread on linux
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        self.scan()  # here rather than at startup, which it would slow down
+        while self.alive:
+            self.wake.clear()
+            for entry in self.recent():
+                while self.alive and self.app.supervisor.busy():  # only while nothing else renders
+                    time.sleep(.5)
+                if not self.alive:  return
+                job = self.app.call(lambda: self.app.warmPreset(entry))
+                if job:  job.wait()
+                self.app.warmSpectrogram(entry['settings'])
+            self.wake.wait()
+
+    def close(self):
+        self.alive = False
+        self.wake.set()
+
+
+# A sox process producing RAW audio on stdout, read ahead by a thread
+class Source:
+    def __init__(self, args, block, spawn):
+        self.proc = spawn('source', args, stdout=PIPE)
+        self.block = block
+        self.blocks = queue.Queue(maxsize=4)
+        self.alive = True
+        self.first = True
+        self.started = time.monotonic()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        first = True
+        while self.alive:
+            data = self.proc.stdout.read(self.block)
+            if data and first:
+                profiler.event('first_byte', kind=self.proc.kind, pid=self.proc.proc.pid,
+                               ms=profiler.since(self.proc.started))
+                first = False
+            self.put(data or None)
+            if not data:  break
+
+    def put(self, data):
+        while self.alive:
+            try:  return self.blocks.put(data, timeout=.1)
+            except queue.Full:  pass
+
+    def ready(self):
+        return not self.blocks.empty()
+
+    def fresh(self):
+        # whether the block just taken is the first with new settings
+        fresh, self.first = self.first, False
+        return fresh
+
+    def get(self, timeout=.1):
+        try:  return self.blocks.get(timeout=timeout)
+        except queue.Empty:  return b''
+
+    def kill(self):
+        self.alive = False
+        self.proc.kill()
+        self.proc.wait()
+
+
+# Like Source, but synthesized in-process; settings apply between blocks
+class EngineSource(Source):
+    def __init__(self, engine):
+        self.engine = engine
+        self.blocks = queue.Queue(maxsize=4)
+        self.alive = True
+        self.started = time.monotonic()
+        self.generation = self.heard = 0  # settings version being made/played
+        self.generations = deque()  # per queued block
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        while self.alive:
+            generation = self.generation
+            try:
+                data = self.engine.read()
+            except Exception as e:  # end the stream, so the next update starts a new engine
+                print('ENGINE ERROR:', e, file=sys.stderr)
+                self.put(None)
+                self.alive = False
+                break
+            self.generations.append(generation)
+            self.put(data)
+
+    def update(self, settings, layers=None):
+        self.engine.update(settings, layers)
+        self.generation += 1
+
+    def fresh(self):
+        generation = self.generations.popleft()
+        fresh, self.heard = generation != self.heard, generation
+        return fresh
+
+    def kill(self):
+        self.alive = False
+
+
+# Writes WAV straight to a pipe, so the wav output needs no sox in between.
+# Like a sink Job, but it outlives pauses: the header is only written once.
+class WavSink:
+    def __init__(self, out):
+        self.stdin = out
+        # sizes are unknown while streaming, so claim the maximum like sox does
+        out.write(struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0xffffffff, b'WAVE', b'fmt ', 16, 1,
+                              CHANNELS, RATE, RATE * FRAME, FRAME, 16, b'data', 0xffffffff))
+        out.flush()
+
+    def poll(self):
+        return None
+
+    def kill(self):
+        pass
+
+    def wait(self, timeout=None):
+        return None
+
+
+def mix(a, b, t0, t1):
+    # equal-power crossfade from a to b, ramped per frame from t0 to t1 (0 to 1 is the whole fade)
+    frames = max(len(a), len(b)) // FRAME
+    np = numpy()
+    if np:
+        a, b = (np.pad(np.frombuffer(x, '<i2'), (0, frames*CHANNELS - len(x)//2)).reshape(-1, CHANNELS) for x in (a, b))
+        t = np.linspace(t0, t1, frames, endpoint=False)[:, None] * (math.pi/2)
+        return np.clip(a*np.cos(t) + b*np.sin(t), -32768, 32767).astype('<i2').tobytes()
+    a, b = array('h', a), array('h', b)
+    if len(a) < len(b):  a.extend([0] * (len(b) - len(a)))
+    if len(b) < len(a):  b.extend([0] * (len(a) - len(b)))
+    step = (t1 - t0) / max(1, frames)
+    return array('h', [max(-32768, min(32767, int(x*math.cos(t) + y*math.sin(t))))
+                       for i, (x, y) in enumerate(zip(a, b)) for t in [(t0 + i//CHANNELS * step) * math.pi/2]]).tobytes()
+
+
+# Feeds one sink process, handing off between sources without gaps:
+# a new source only takes over once it has audio, and is crossfaded in.
+# Writes are batched per period; underruns and the latency achieved are
+# estimated by comparing the audio written against the wall clock.
+class Player:
+    def __init__(self, output, crossfade=0.25, block=1024, spawn=None, period=None, buffer=None, latency=None):
+        self.output = output
+        self.spawn = spawn or Supervisor(1).spawn
+        self.crossfade = crossfade
+        self.block = block * FRAME
+        self.period = (period or block) * FRAME  # bytes per write
+        self.buffer = buffer  # sox's buffer in bytes
+        self.latency = latency  # target in ms
+        self.wav = None
+        self.underruns = self.writes = 0
+        self.achieved = 0  # seconds written ahead of playback, smoothed
+        self.sink = None
+        self.current = None
+        self.incoming = None
+        self.last_switch = None  # seconds from start() until audio switched
+        self.requested = None  # when the last change was made, for latency
+        self.gain = 1  # applied to whatever plays, so volume changes need no new source
+        self.tap = None  # tap(data) sees everything written, e.g. Ring.write
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def playing(self):
+        return self.sink is not None
+
+    def start(self, source):
+        if isinstance(source, list):  source = Source(source, self.block, self.spawn)
+        with self.lock:
+            stale, self.incoming = self.incoming, source
+        if stale:  stale.kill()
+        if not self.sink:
+            self.sink = self.openSink()
+            thread = threading.Thread(target=self.run, args=(self.sink,), daemon=True)
+            thread.start()
+            self.thread = thread
+
+    def openSink(self):
+        if self.output == ['-twav', '-']:
+            if not self.wav:
+                if self.latency:  self.pipeSize(sys.stdout, int(self.latency / 1000 * RATE))
+                self.wav = WavSink(sys.stdout.buffer)
+            return self.wav
+        env, buffer = None, self.buffer
+        if self.latency:
+            env = {**os.environ, 'PULSE_LATENCY_MSEC': str(self.latency)}
+            # split the target between the pipe and sox's own buffer of 32bit samples
+            frames = int(self.latency / 2000 * RATE)
+            buffer = buffer or frames * CHANNELS * 4
+        sink = self.spawn('sink', ['sox', *([f'--buffer={buffer}'] if buffer else []), *RAW, '-', *self.output],
+                          stdin=PIPE, env=env)
+        if self.latency:  self.pipeSize(sink.stdin, frames)
+        return sink
+
+    def pipeSize(self, pipe, frames):
+        try:  # the kernel rounds up to a page
+            fcntl.fcntl(pipe, getattr(fcntl, 'F_SETPIPE_SZ', 1031), frames * FRAME)
+        except OSError as e:  # not a pipe
+            print('LATENCY ERROR:', e, file=sys.stderr)
+
+    def stop(self):
+        with self.lock:
+            sink, self.sink = self.sink, None
+            sources = [self.current, self.incoming]
+            self.current = self.incoming = None
+        for source in sources:
+            if source:  source.kill()
+        if sink:
+            sink.kill()
+            sink.wait()
+        if self.thread:  self.thread.join()
+
+    def stats(self):
+        return {'underruns': self.underruns, 'writes': self.writes, 'latency_ms': round(self.achieved * 1000, 1),
+                'target_ms': self.latency}
+
+    def run(self, sink):
+        fading, pos, gain = None, 0, 1
+        fade_len = max(1, int(self.crossfade * RATE))
+        pending, clock, written = bytearray(), None, 0
+        while self.sink is sink:
+            with self.lock:
+                if self.incoming and not fading and self.incoming.ready():
+                    fading, pos = self.current, 0
+                    self.current, self.incoming = self.incoming, None
+                    self.last_switch = time.monotonic() - self.current.started
+                    print(f' ~~~> switched in {self.last_switch*1000:.0f}ms', file=sys.stderr)
+                    profiler.event('switch', ms=self.last_switch * 1000)
+                current = self.current
+            if not current:
+                time.sleep(.005)
+                continue
+            data = current.get()
+            if data is None:  # source ended
+                with self.lock:
+                    if self.current is current:  self.current = None
+                continue
+            elif not data:
+                continue
+            if current.fresh() and self.requested:
+                profiler.event('latency', ms=profiler.since(self.requested))
+                self.requested = None
+            if fading:
+                frames = len(data) // FRAME
+                old = fading.get(.02)  # it is usually ahead, but don't fade against silence if it lags
+                if old is None:  pos = fade_len  # it ended, nothing left to fade out
+                data = mix(old or b'', data, min(1, pos / fade_len), min(1, (pos + frames) / fade_len))
+                pos += frames
+                if pos >= fade_len:
+                    fading.kill()
+                    fading = None
+            if gain != 1 or self.gain != 1:
+                data = scale(data, gain, self.gain)
+                gain = self.gain
+            if self.tap:  self.tap(data)
+            pending += data
+            if len(pending) < self.period:  continue
+            now = time.monotonic()
+            ahead = written - (now - clock) if clock else 0
+            if ahead < 0:  # the output ran dry before this write
+                self.underruns += 1
+                profiler.event('underrun', ms=-ahead * 1000)
+            if ahead <= 0:  clock, written = now, 0
+            try:
+                sink.stdin.write(pending)
+                sink.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                break
+            self.writes += 1
+            written += len(pending) / (RATE * FRAME)
+            self.achieved += (written - (time.monotonic() - clock) - self.achieved) * .05
+            pending.clear()
+        if fading:  fading.kill()
+
+
+# The most recent audio, written by the Player and read by the analyzer
+# without locking: readers copy, then check they weren't lapped meanwhile.
+class Ring:
+    def __init__(self, size):
+        self.size = size  # a multiple of FRAME
+        self.data = bytearray(size)
+        self.written = 0  # bytes ever written
+
+    def write(self, data):
+        n = len(data)
+        data = data[-self.size:]
+        start = (self.written + n - len(data)) % self.size
+        first = min(len(data), self.size - start)
+        self.data[start:start + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+        self.written += n
+
+    def read(self, n):
+        # the latest n bytes, or None if there's no such audio (anymore)
+        end = self.written
+        if not 0 < n <= min(end, self.size):  return None
+        start = (end - n) % self.size
+        data = bytes(self.data[start:start + n]) + bytes(self.data[:max(0, start + n - self.size)])
+        if self.written - end > self.size - n:  return None
+        return data
+
+
+# Live spectrum of what is actually playing, one column per frame. The FFTs
+# run on a worker thread at most fps times a second; frames are dropped
+# while the last one isn't painted yet or when they'd exceed the cpu budget.
+class Analyzer:
+    def __init__(self, paint, height, fps=15, budget=5):
+        import sox_noise_numpy
+        self.ring = Ring(2**17)
+        self.waterfall = sox_noise_numpy.Waterfall(SPEC_WIDTH, height, CHANNELS)
+        self.height = height
+        self.paint = paint  # paint(analyzer, rgb) from the worker, hands it to the main loop
+        self.interval = 1 / fps
+        self.budget = budget / 100  # share of one core
+        self.painting = False  # until the last frame was shown
+        self.frames = self.dropped = 0
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        read, due, credit = self.ring.written, time.monotonic(), 0
+        allowance = self.interval * self.budget  # cpu seconds per frame
+        while self.alive:
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            due = max(due + self.interval, time.monotonic())  # late frames aren't caught up
+            credit = min(credit + allowance, allowance)
+            if self.painting or credit < 0:
+                self.dropped += 1
+                continue
+            written = self.ring.written
+            pcm = self.ring.read(min(written - read, self.ring.size // 2))
+            read = written
+            if not pcm:  continue
+            started = time.thread_time()
+            rgb = self.waterfall.push(pcm)
+            cpu = time.thread_time() - started
+            credit -= cpu
+            if rgb is None:  continue
+            profiler.event('analyzer', ms=cpu * 1000)
+            self.frames += 1
+            self.painting = True
+            self.paint(self, rgb)
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+        print(f' analyzer: {self.frames} frames, {self.dropped} dropped', file=sys.stderr)
+
+
+# numpy speeds up the gain and crossfades, but takes ~70ms to import. That
+# runs in the background, the array code fills in until it's done.
+numpy_module = []  # filled by importNumpy()
+
+@lru_cache(maxsize=None)
+def hasNumpy():
+    return importlib.util.find_spec('numpy') is not None
+
+def numpy():
+    return numpy_module[0] if numpy_module else None
+
+def importNumpy():
+    try:
+        import numpy
+    except ImportError:
+        return
+    numpy_module.append(numpy)
+
+
+def scale(data, g0, g1):
+    # ramps the gain from g0 to g1 over the block, so volume changes don't click
+    np = numpy()
+    if np:  # vectorized, and only ramped while the gain changes
+        x = np.frombuffer(data, '<i2').reshape(-1, CHANNELS)
+        gain = g1 if g0 == g1 else np.linspace(g0, g1, len(x), endpoint=False)[:, None]
+        return np.clip(x * gain, -32768, 32767).astype('<i2').tobytes()
+    a = array('h', data)
+    step = (g1 - g0) / max(1, len(a))
+    return array('h', [max(-32768, min(32767, int(x * (g0 + i*step))))
+                       for i, x in enumerate(a)]).tobytes()
+
+
+# Immutable snapshot of everything that shapes the sound. diff() tells what
+# kind of settings changed, so only the stages depending on them are redone.
+class Params:
+    KINDS = {
+        'gain':     ['volume'],
+        'filter':   ['noise', 'band_center', 'band_width', 'lowpass', 'extras'],
+        'effect':   ['tremolo_speed', 'tremolo_depth', 'reverb', 'layers'],
+        'duration': ['duration', 'fade', 'endless'],
+        'output':   ['output'],
+    }
+    STAGES = {
+        'play':        {'filter', 'effect', 'duration', 'output'},  # gain is applied live
+        'save':        {'gain', 'filter', 'effect', 'duration'},
+        'spectrogram': {'filter'},
+    }
+    __slots__ = [k for fields in KINDS.values() for k in fields]
+
+    def __init__(self, **values):
+        for k in self.__slots__:
+            v = values.get(k)
+            if isinstance(v, list):  v = tuple(v)
+            # sliders give floats, so 800.0 and 800 make the same sox args and cache keys
+            if isinstance(v, float) and v.is_integer():  v = int(v)
+            object.__setattr__(self, k, v)
+
+    @classmethod
+    def fromApp(cls, app):
+        return cls(**app.settings(), layers=[cls(**layer) for layer in app.layers],
+                   endless=app.pargs.endless, output=app.pargs.output)
+
+    @classmethod
+    def fromArgs(cls, pargs, layers=()):
+        return cls(**{k: getattr(pargs, k, None) for k in cls.__slots__ if k != 'layers'},
+                   layers=[cls(**layer) for layer in layers])
+
+    def __setattr__(self, k, v):
+        raise AttributeError('Params are immutable, use replace()')
+
+    def __repr__(self):
+        return f'Params({", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__)})'
+
+    def __eq__(self, other):
+        return isinstance(other, Params) and self.values() == other.values()
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def values(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def replace(self, **changes):
+        return Params(**{**{k: getattr(self, k) for k in self.__slots__}, **changes})
+
+    def settings(self):
+        # the dict effectArgs and the numpy engine take
+        return {k: list(getattr(self, k)) if k == 'extras' and self.extras else getattr(self, k)
+                for k in CONTROLS}
+
+    @property
+    def gain(self):
+        return self.volume/100 if self.volume <= 100 else 10**((self.volume-100) / 20)
+
+    def diff(self, other):
+        # the kinds of settings that differ, everything against None
+        if other is None:  return set(self.KINDS)
+        return {kind for kind, fields in self.KINDS.items()
+                if any(getattr(self, k) != getattr(other, k) for k in fields)}
+
+    @property
+    def live_gain(self):
+        # a lone layer's volume can be applied by the Player, so it needs no new
+        # render; without numpy that costs more than rendering, and mixed layers
+        # each have their own volume
+        return not self.layers and hasNumpy()
+
+    @property
+    def sox_only(self):
+        # extras are sox effects, the numpy engine can't apply them
+        return any(p.extras for p in [self, *self.layers])
+
+    def playback(self):
+        return self.replace(volume=100) if self.live_gain else self
+
+    def stages(self, changes):
+        stages = {stage for stage, kinds in self.STAGES.items() if changes & kinds}
+        if 'gain' in changes and not self.live_gain:  stages.add('play')
+        return stages
+
+
+# sox command synthesizing one layer's settings into output
+def effectArgs(s, output, full=True, repeat=True, endless=False):
+    # endless: synthesize forever instead of repeating a faded loop
+    vol = s['volume']
+    return ['sox', f'-c{2 if full else 1}', '--null', *output,
+        'synth', *([] if endless else [f'0:{s["duration"] if full else 1}']), f'{s["noise"]}noise',
+        'band', '-n', str(s['band_center']), str(s['band_width'])] + ([
+        'lowpass', '-1', str(s['lowpass'])] if s['lowpass'] else []) + ([
+        'tremolo', str(s['tremolo_speed']/s['duration']), str(s['tremolo_depth']),
+        'reverb', str(s['reverb'])] + ([
+        'vol', str(vol/100)] if vol <= 100 else ['gain', str(vol-100)]) + ([] if endless else [
+        'fade', 'q', str(s['fade']), f'0:{s["duration"]}', str(s['fade'])]) if full else []) + (
+        s['extras'] if s['extras'] else []) + ([
+        'repeat', '-'] if full and repeat and not endless else [])
+
+
+# sox commands for a chunked export: the chunks carry the filters and the
+# reverb, the stitcher what depends on the position in the whole track
+def chunkArgs(s, output, length, preroll=0):
+    return ['sox', '-c2', '--null', *output, 'synth', str(length + preroll), f'{s["noise"]}noise',
+        'band', '-n', str(s['band_center']), str(s['band_width'])] + ([
+        'lowpass', '-1', str(s['lowpass'])] if s['lowpass'] else []) + [
+        'reverb', str(s['reverb'])] + (s['extras'] or []) + (['trim', str(preroll)] if preroll else [])
+
+
+def stitchArgs(s, output):
+    vol = s['volume']
+    return ['sox', *RAW, '-', *output,
+        'tremolo', str(s['tremolo_speed']/s['duration']), str(s['tremolo_depth'])] + ([
+        'vol', str(vol/100)] if vol <= 100 else ['gain', str(vol-100)]) + [
+        'fade', 'q', str(s['fade']), f'0:{s["duration"]}', str(s['fade'])]
+
+
+def crossfade(a, b):
+    # equal-power, from a to b over two equally long blocks
+    return mix(a, b, 0, 1)
+
+
+# Renders a long export as time chunks in parallel sox processes and streams
+# them in order into one sink, so the track never sits in memory. The
+# tremolo, volume and fades run in the sink over the whole track and stay
+# continuous; the chunks overlap by a short crossfade and start early so
+# their reverb has settled. Like a Job: poll(), wait() and kill().
+class Export:
+    def __init__(self, settings, output, spawn, jobs, chunk=60, location=None, xfade=.1):
+        self.settings = settings
+        self.output = output
+        self.spawn = spawn
+        self.jobs = max(1, jobs)  # chunks rendered ahead of the stitcher
+        self.chunk = chunk
+        self.location = location
+        self.xfade = int(xfade * RATE) * FRAME  # bytes
+        self.returncode = None
+        self.running = {}  # chunk index: (Job, raw file)
+        self.sink = None
+        self.cancelled = False
+        self.done = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        self.cancelled = True
+        for job, _ in list(self.running.values()):
+            job.kill()
+        if self.sink:  self.sink.kill()
+
+    def run(self):
+        try:
+            os.makedirs(self.location or tempfile.gettempdir(), exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=self.location) as tmp:  # raw chunks can be big for /tmp
+                self.returncode = self.stitch(tmp)
+        except (OSError, ValueError) as e:  # including the sink going away when killed
+            if not self.cancelled:  print('EXPORT ERROR:', e, file=sys.stderr)
+            self.returncode = -signal.SIGKILL if self.cancelled else 1
+        finally:
+            self.done.set()
+
+    def render(self, i, tmp):
+        s, xfade = self.settings, self.xfade / FRAME / RATE
+        start = i * self.chunk - (xfade if i else 0)
+        length = min((i + 1) * self.chunk, s['duration']) - start
+        path = os.path.join(tmp, f'{i}.raw')
+        args = chunkArgs(s, [*RAW, path], length, preroll=.5 if s['reverb'] else 0)
+        self.running[i] = (self.spawn('export', args, stderr=DEVNULL), path)
+
+    def stitch(self, tmp):
+        started = time.monotonic()
+        total = self.settings['duration']
+        count = -(-total // self.chunk)
+        self.sink = self.spawn('stitch', stitchArgs(self.settings, self.output), stdin=PIPE, stderr=DEVNULL)
+        ahead, tail, cpu = 0, b'', 0
+        for i in range(count):
+            while ahead < min(count, i + 1 + self.jobs):
+                self.render(ahead, tmp)
+                ahead += 1
+            job, path = self.running[i]
+            if job.wait() != 0 or self.cancelled:
+                self.kill()
+                return job.returncode or -signal.SIGKILL
+            del self.running[i]
+            cpu += job.cpu
+            keep = self.xfade if i < count - 1 else 0  # crossfaded into the next chunk
+            with open(path, 'rb') as f:
+                if tail:  self.sink.stdin.write(crossfade(tail, f.read(len(tail))))
+                data = b''
+                while block := f.read(2**20):
+                    data += block
+                    self.sink.stdin.write(data[:len(data) - keep])
+                    data = data[len(data) - keep:]
+                tail = data
+            os.remove(path)
+            wall = time.monotonic() - started
+            done = min((i + 1) * self.chunk, total)
+            print(f' ---> export {i + 1}/{count} chunks ({done / total:.0%}): {done / wall:.1f}x realtime,'
+                  f' {cpu / wall:.1f} cores', file=sys.stderr)
+            profiler.event('export', chunk=i, of=count, seconds=done, ms=wall * 1000)
+        self.sink.stdin.close()
+        return self.sink.wait()
+
+
+# Debounces work per kind ('play', 'save', 'spectrogram') so rapid edits only
+# render the latest settings, and kills in-flight jobs made stale by them.
+class Scheduler:
+    def __init__(self, later, delay=50):
+        self.later = later  # later(ms, fn) calls fn once from the main loop
+        self.delay = delay
+        self.pending = {}  # kind: fn
+        self.running = {}  # kind: job returned by fn, with poll() and kill()
+        self.counters = {'submitted': 0, 'coalesced': 0, 'cancelled': 0}
+
+    def submit(self, kind, fn):
+        self.counters['submitted'] += 1
+        if kind in self.pending:
+            self.counters['coalesced'] += 1
+        else:
+            self.later(self.delay, lambda: self.run(kind))
+        self.pending[kind] = fn
+
+    def run(self, kind):
+        fn = self.pending.pop(kind)
+        stale = self.running.pop(kind, None)
+        if stale and stale.poll() is None:
+            stale.kill()
+            self.counters['cancelled'] += 1
+        job = fn()
+        if job:  self.running[kind] = job
+        return False  # don't repeat
+
+
+# Line-based control API on a unix socket, one thread per client:
+#   get [name...] | set name value [name value...] | load file.sxn | preset [name|number]
+#   | play | pause | toggle
+# Every command is answered with one line of JSON.
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, app):
+        self.app = app
+        if os.path.exists(path):
+            # only take over a socket nobody is listening on anymore
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if os.path.exists(path):  os.remove(path)  # stale socket
+            else:
+                raise OSError(errno.EADDRINUSE, 'another instance is listening on', path)
+            finally:
+                probe.close()
+        super().__init__(path, ControlHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):  os.remove(self.server_address)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.app.control(line.decode().split())
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+# Exits on bad command line arguments like argparse, but raises ValueError
+# while presets are parsed, so one bad .sxn can't take the running app down
+class ArgumentParser(argparse.ArgumentParser):
+    presets = False
+
+    def error(self, message):
+        if self.presets:  raise ValueError(message)
+        super().error(message)
+
+
+# Argument/config handling, effect chain and playback, shared by the window and headless modes
+class SoxNoiseCore:
+    def parseOptions(self, args):
+        # the command line over the config file, without side effects so start() can pick the mode
         self.config_location = os.path.join(os.getenv('XDG_CONFIG_HOME', '~/.config'), 'sox-noise')
+        self.cache_location = os.path.join(os.getenv('XDG_CACHE_HOME', '~/.cache'), 'sox-noise')
         default_conf = os.path.join(self.config_location, 'default.sxn')
-        output_mapping = {
-            'pulse':   ['-tpulseaudio'],
-            'alsa':    ['-talsa'],
-            'wav':     ['-twav', '-'],
-            'sox':     ['-tsox', '-'],
-            'default': ['-d'],
-        }
-
+        default_sock = os.path.join(os.getenv('XDG_RUNTIME_DIR', tempfile.gettempdir()), 'sox-noise.sock')
         # parse args
         conf_parser = argparse.ArgumentParser(add_help=False)
         conf_parser.add_argument('--config', help=f'Configuration file location (default: {default_conf})')
         cargs, remaining_args = conf_parser.parse_known_args(args)
-        parser = argparse.ArgumentParser(description='Noise Generator powered by SoX.', parents=[conf_parser])
+        parser = ArgumentParser(description='Noise Generator powered by SoX.', parents=[conf_parser])
         parser.add_argument('noise', choices=['brown', 'pink', 'white', 'tpdf'],
             nargs='?', default='brown', help='The "color" of noise')
         parser.add_argument('--play',          action='store_true',    help='Start playing on open')
@@ -62,47 +1074,440 @@ class SoxNoise:
         parser.add_argument('--tremolo-depth', type=int,  default=30,  help='Tremolo intensity [0-100]')
         parser.add_argument('--lowpass',       type=int,  default=0,   help='Lowpass filter width (disable with 0)')
         parser.add_argument('--duration',      type=int,  default=60,  help='How many seconds to generate noise before looping (default: 60)')
+        parser.add_argument('--endless',       action='store_true',    help='Stream noise forever instead of looping --duration seconds (tremolo speed still uses it)')
         parser.add_argument('--fade',          type=float,default=.005,help='How long to fade in/out on loop. Prevents clicking/popping (default: 0.005)')
         parser.add_argument('--tray',          action='store_true',    help='Show an icon in the system tray')
         parser.add_argument('--hide',          action='store_true',    help="Don't show the window")
         parser.add_argument('--save',          help='Save sound to filename')
-        parser.add_argument('--output',        choices=output_mapping.keys(), default='default', help='Output device/format')
+        parser.add_argument('--output',        choices=OUTPUTS.keys(), default='default', help='Output device/format')
         parser.add_argument('--spectrogram',   action='store_true',    help='Show the spectrogram')
+        parser.add_argument('--analyzer-fps',  type=int,  default=15,  help='Live spectrogram frames per second while playing (disable with 0)')
+        parser.add_argument('--analyzer-budget', type=float, default=5, help='Max CPU for the live spectrogram in percent of a core (default: 5)')
         parser.add_argument('--extras',        nargs='+',              help='Extra arguments to pass to sox')
+        parser.add_argument('--layer',         action='append',        help='Mix in another sound, e.g. "noise=pink band_center=2000 volume=40" (repeatable)')
+        parser.add_argument('--engine',        choices=['sox', 'numpy'], default='sox', help='Synthesize with sox or in-process with numpy')
+        parser.add_argument('--period',        type=int,               help='Frames per write to the output (default: 1024, 8192 for wav/sox)')
+        parser.add_argument('--buffer',        type=int,               help="Size of sox's output buffer in bytes (default: from --latency)")
+        parser.add_argument('--latency',       type=int,               help='Target output latency in ms, sizes the buffers (default: system)')
+        parser.add_argument('--crossfade',     type=float,default=.25, help='Seconds to crossfade when settings change (default: 0.25)')
+        parser.add_argument('--cache-size',    type=int,  default=512, help='Max size of rendered loop cache in MB (disable with 0)')
+        parser.add_argument('--chunk',         type=int,  default=60,  help='Save tracks longer than twice this many seconds in parallel chunks (disable with 0)')
+        parser.add_argument('--warm',          type=int,  default=3,   help='Pre-render this many recently used presets in the background (disable with 0)')
+        parser.add_argument('--max-jobs',      type=int,  default=os.cpu_count(), help='Max background sox processes at once (default: number of cores)')
+        parser.add_argument('--control',       nargs='?', const=default_sock, help=f'Listen for commands on a unix socket (default: {default_sock})')
+        parser.add_argument('--profile',       nargs='?', const='-',   help='Write JSON-lines timing events to a file (default: stderr)')
+        parser.add_argument('--profile-summary', action='store_true',  help='Print timing percentiles on exit')
+        parser.add_argument('--headless',      action='store_true',    help="Play without a window, never loads GTK")
         parser.add_argument('--version',       action='version',       help=version, version=version)
         self.defaults = parser.parse_args([])
         self.parser = parser
+        self.parser_lock = threading.Lock()  # presets are parsed on the warm thread too
 
         # parse config
         self.cpath = os.path.expanduser(cargs.config or default_conf)
+        copts = None
         if os.path.exists(self.cpath):
             copts = self.parseConfig(self.cpath)
             parser.set_defaults(**copts)  # unfortunatly this borks the ArgumentDefaultsHelpFormatter
-            self.pargs = parser.parse_args(remaining_args)
+        self.pargs = parser.parse_args(remaining_args)
+        return cargs.config, copts
+
+    def parseArgs(self, args):
+        started = time.monotonic()
+        config, copts = self.parseOptions(args)
+        if copts is not None:
             print("Config:", self.cpath, copts, file=sys.stderr)  # avoid printing on help
-        else:
-            self.pargs = parser.parse_args(remaining_args)
-            if cargs.config:  print('Config file not found:', self.cpath, file=sys.stderr)
-            else:  # create default config file
-                os.makedirs(os.path.dirname(self.cpath), exist_ok=True)
-                with open(self.cpath, 'w') as configfile:
-                    configfile.write('[sox-noise]\n');
+        elif config:
+            print('Config file not found:', self.cpath, file=sys.stderr)
+        else:  # create default config file
+            os.makedirs(os.path.dirname(self.cpath), exist_ok=True)
+            with open(self.cpath, 'w') as configfile:
+                configfile.write('[sox-noise]\n');
+
+        profiler.collect = self.pargs.profile_summary
+        if self.pargs.profile:  profiler.open(self.pargs.profile)
+        profiler.event('config', path=self.cpath, ms=profiler.since(started))
 
         # set initial values
-        self.subp = None
+        self.layers = [self.layerSettings(dict(kv.split('=', 1) for kv in spec.split()), self.pargs)
+                       for spec in self.pargs.layer or []]
+        if os.path.exists(self.cpath):
+            self.layers += self.parseLayers(self.cpath, self.pargs)
+        self.engine_source = None
+        if hasNumpy():  threading.Thread(target=importNumpy, daemon=True).start()
+        if self.pargs.engine == 'numpy':
+            try:
+                import sox_noise_numpy
+            except ImportError as e:
+                print('ENGINE ERROR:', e, file=sys.stderr)
+                self.pargs.engine = 'sox'
+        self.supervisor = Supervisor(self.pargs.max_jobs)
+        self.cache = RenderCache(os.path.expanduser(self.cache_location), self.pargs.cache_size * 2**20,
+                                 self.supervisor.spawn)
+        self.caching = None  # chain the last play() is rendering into the cache
+        self.preset = self.cpath
+        self.library = PresetLibrary(os.path.expanduser(self.config_location),
+            os.path.join(os.path.expanduser(self.cache_location), 'presets.json'), self, self.pargs.warm)
         self.save = self.pargs.save
         self.noise = self.pargs.noise
         self.duration = self.pargs.duration
-        self.last_sound_fname = 'noise.ogg'
-        self.last_config_fname = 'noise.sxn'
-        self.resetSettings(self.pargs)
         out_split = self.pargs.output.split(',', 1)
-        self.output = output_mapping.get(out_split[0])
+        self.output = OUTPUTS.get(out_split[0])
         if len(out_split) > 1:
             # allows for "--output=alsa,hw:0,1"
             self.output = [self.output[0], out_split[1]]
+        # without a latency target, large writes to pipes only save wakeups
+        period = self.pargs.period or (8192 if self.pargs.output in ['wav', 'sox'] and not self.pargs.latency else None)
+        self.player = Player(self.output, self.pargs.crossfade, spawn=self.supervisor.spawn, period=period,
+                             buffer=self.pargs.buffer, latency=self.pargs.latency)
+        self.params = None  # what the current playback, save and spectrogram were made from
+        self.lock = threading.RLock()
+        self.control_server = None
+        if self.pargs.control:
+            try:
+                self.control_server = ControlServer(self.pargs.control, self)
+            except OSError as e:
+                print('CONTROL ERROR:', e, file=sys.stderr)
+        self.library.start()
         if self.pargs.output not in ['wav', 'sox'] and os.fstat(0) != os.fstat(1):
             print('WARNING: Redirect Detected: Use the "--output=wav" or "--output=sox" arguments to redirect sound data!', file=sys.stderr)
+
+    def parseConfig(self, cpath):
+        config = configparser.ConfigParser()
+        config.read([cpath])
+        if not config.sections():  raise ValueError(f'no settings in {cpath}')
+        copts = { k.replace('-', '_'): v
+                  for k, v in config.items(config.sections()[0]) }
+        if 'extras' in copts:  copts['extras'] = copts['extras'].split(' ')
+        return copts
+
+    def parseLayers(self, cpath, pargs):
+        # extra layers are the [layer...] sections after the first
+        config = configparser.ConfigParser()
+        config.read([cpath])
+        return [self.layerSettings(dict(config.items(name)), pargs)
+                for name in config.sections()[1:] if name.startswith('layer')]
+
+    def layerSettings(self, opts, pargs):
+        # unset values fall back to the defaults, duration and fade to the main sound's
+        layer = {k: getattr(self.defaults, k) for k in CONTROLS}
+        layer.update(duration=pargs.duration, fade=pargs.fade)
+        for k, v in opts.items():
+            k = k.replace('-', '_')
+            if k not in CONTROLS:  raise ValueError(f'unknown layer setting: {k}')
+            layer[k] = v.split(' ') if k == 'extras' else type(getattr(self.defaults, k))(v)
+        return layer
+
+    def onDestroy(self, *args):
+        if getattr(self, 'control_server', False):
+            self.control_server.shutdown()
+            self.control_server.server_close()
+        if getattr(self, 'scheduler', False):
+            print(' scheduler:', self.scheduler.counters, file=sys.stderr)
+        if getattr(self, 'library', False):  self.library.close()
+        if getattr(self, 'analyzer', None):  self.analyzer.stop()
+        if getattr(self, 'player', False):
+            self.player.stop()
+            s = self.player.stats()
+            if s['writes']:
+                print(f' output: {s["underruns"]} underruns, {s["writes"]} writes, {s["latency_ms"]:.0f}ms latency'
+                      f' (target {s["target_ms"] or "default"})', file=sys.stderr)
+        if getattr(self, 'cache', False):  self.cache.close()
+        if getattr(self, 'supervisor', False):
+            self.supervisor.shutdown()
+            for kind, s in self.supervisor.stats().items():
+                print(f' {kind}: {s["jobs"]} jobs, {s["wall"]:.2f}s wall, {s["cpu"]:.2f}s cpu,'
+                      f' {s["rss"] / 2**20:.0f}MB peak rss', file=sys.stderr)
+        if getattr(self, 'pargs', False) and self.pargs.profile_summary:  profiler.summary()
+        sys.exit()
+
+    def saveSound(self, widget=None):
+        if widget:  # button clicked
+            filename = self.dialog('Save Sound', audio=True, save=True, filename=self.last_sound_fname)
+            if not filename:  return
+        elif self.save:
+            filename = self.save
+        else:  return
+        self.last_sound_fname = filename
+        params = Params.fromApp(self)
+        # long single layer tracks render faster in parallel chunks
+        if (self.pargs.chunk and params.duration > 2 * self.pargs.chunk
+                and self.supervisor.max_jobs > 1 and not params.layers):
+            return Export(params.settings(), [filename], self.supervisor.spawn, self.supervisor.max_jobs,
+                          self.pargs.chunk, os.path.expanduser(self.cache_location))
+        args = self.getArgs([filename], repeat=False, params=params)
+        # print('\n save===>', ' '.join(args), file=sys.stderr)
+        return self.supervisor.spawn('save', args)
+
+    def getArgs(self, output, full=True, repeat=True, endless=False, params=None):
+        params = params or Params.fromApp(self)
+        layers = [params, *params.layers] if full else [params]
+        if len(layers) == 1:
+            return effectArgs(params.settings(), output, full, repeat, endless)
+        # one sox mixes the layers, each synthesized by its own pipeline
+        inputs = [arg for layer in layers for arg in
+                  ['-v1', '|' + shlex.join(effectArgs(layer.settings(), ['-p'], full, repeat, endless))]]
+        return ['sox', '-m', *inputs, *output]
+
+    def play(self, button=None):
+        if not self.isPlaying():
+            return self.player.stop()
+        params = self.playbackParams()
+        engine = self.useEngine(params)
+        chain = None if engine or params.endless else self.getArgs([], repeat=False, params=params)
+        if self.caching and self.caching != chain:  # the previous settings will not be played again soon
+            self.cache.cancel(self.caching)
+            self.caching = None
+        if engine:
+            return self.playEngine(params)  # always endless
+        self.engine_source = None  # not what's playing anymore
+        if params.endless:
+            args = self.getArgs([*RAW, '-'], endless=True, params=params)
+            print('\n ===>', ' '.join(args), file=sys.stderr)
+            return self.player.start(args)
+        cached = self.cache.get(chain)
+        if cached:  # stream the rendered loop, no synthesis needed
+            args = ['sox', cached, *RAW, '-', 'repeat', '-']
+        else:
+            args = self.getArgs([*RAW, '-'], params=params)
+            self.cache.render(chain, lambda out: self.getArgs(out, repeat=False, params=params))
+            self.caching = chain
+        print('\n ===>', ' '.join(args), file=sys.stderr)
+        self.player.start(args)
+
+    def playbackParams(self):
+        params = Params.fromApp(self)
+        self.player.gain = params.gain if params.live_gain else 1
+        return params.playback()
+
+    def warmPreset(self, entry):
+        # renders the loop play() would stream for a preset, at idle priority
+        if self.pargs.endless:  return None
+        params = Params(**entry['settings'], layers=[Params(**layer) for layer in entry['layers']]).playback()
+        if self.pargs.engine == 'numpy' and not params.sox_only:  return None
+        chain = self.getArgs([], repeat=False, params=params)
+        if self.cache.get(chain):  return None
+        return self.cache.render(chain, lambda out: ['nice', '-n19', *self.getArgs(out, repeat=False, params=params)])
+
+    def warmSpectrogram(self, settings):
+        pass
+
+    def usePreset(self, path):
+        # switch to an indexed preset without parsing it again
+        entry = self.library.use(path)
+        self.preset = path
+        pargs = argparse.Namespace(**{**vars(self.defaults), **entry['settings']})
+        self.layers = [dict(layer) for layer in entry['layers']]
+        self.duration = pargs.duration
+        self.resetSettings(pargs)
+
+    def useEngine(self, params):
+        # extras only work through sox, so those settings fall back to it
+        if self.pargs.engine != 'numpy':  return False
+        if params.sox_only:
+            print(' ===> extras need the sox engine, using it instead of numpy', file=sys.stderr)
+            return False
+        return True
+
+    def playEngine(self, params):
+        settings, layers = params.settings(), [layer.settings() for layer in params.layers]
+        if self.player.playing and self.engine_source and self.engine_source.alive:
+            return self.engine_source.update(settings, layers)  # no restart needed
+        import sox_noise_numpy
+        engine = sox_noise_numpy.Engine(settings, RATE, CHANNELS, self.player.block // FRAME, layers=layers)
+        self.engine_source = EngineSource(engine)
+        self.player.start(self.engine_source)
+
+    def update(self):
+        # redo only the stages that depend on what changed since last time
+        params = Params.fromApp(self)
+        stages = params.stages(params.diff(self.params))
+        self.params = params
+        if 'spectrogram' in stages:  self.showSpectrogram()
+        if 'save' in stages:  self.schedule('save', self.saveSound)
+        if not self.player.playing:  return
+        if 'play' in stages:
+            self.player.requested = time.monotonic()
+            self.schedule('play', self.play)
+        else:
+            self.playbackParams()  # volume only
+
+    def schedule(self, kind, fn):
+        fn()
+
+    def showSpectrogram(self, widget=None, event=None):
+        pass
+
+    def settings(self):
+        return {
+            'noise': self.noise,
+            'duration': self.duration,
+            **{ k: getattr(self, k).get_value() for k in SLIDERS },
+            'fade': self.fade,
+            'extras': self.extras,
+        }
+
+    def isPlaying(self):
+        return True
+
+    def presetArgs(self, filename):
+        copts = self.parseConfig(filename)
+        with self.parser_lock:
+            self.parser.set_defaults(**vars(self.defaults))
+            self.parser.set_defaults(**copts)
+            self.parser.presets = True
+            try:
+                return self.parser.parse_args([])
+            finally:
+                self.parser.presets = False
+
+    def control(self, words):
+        command, args = (words[0], words[1:]) if words else ('', [])
+        if command == 'get':
+            state = self.call(self.state)
+            return {k: state[k] for k in args} if args else state
+        elif command == 'set':
+            if not args or len(args) % 2:  raise ValueError('usage: set name value [name value...]')
+            updates = {}
+            for name, value in zip(args[::2], args[1::2]):
+                name = name.replace('-', '_')
+                if name not in CONTROLS:  raise ValueError(f'unknown setting: {name}')
+                if name == 'extras':
+                    value = value.split(',') if value else None
+                elif name == 'noise':
+                    if value not in ['brown', 'pink', 'white', 'tpdf']:  raise ValueError(f'unknown noise: {value}')
+                else:
+                    value = type(getattr(self.defaults, name))(value)
+                    if name == 'duration' and value <= 0:  raise ValueError('duration must be positive')
+                updates[name] = value
+            self.player.requested = time.monotonic()
+            self.call(lambda: self.apply(updates))
+        elif command == 'load':
+            if len(args) != 1 or not os.path.exists(args[0]):  raise ValueError('usage: load file.sxn')
+            self.call(lambda: self.loadSettings(filename=args[0]))
+        elif command == 'preset':
+            self.call(self.library.scan)
+            if not args:  return {'presets': [os.path.basename(path) for path in self.library.paths()]}
+            path = self.library.find(args[0])
+            if not path:
+                error = self.library.error(args[0])
+                raise ValueError(f'broken preset {args[0]}: {error}' if error else f'unknown preset: {args[0]}')
+            self.player.requested = time.monotonic()
+            self.call(lambda: self.usePreset(path))
+        elif command in ['play', 'pause', 'toggle']:
+            self.call(lambda: self.setPlaying(
+                not self.isPlaying() if command == 'toggle' else command == 'play'))
+        else:
+            raise ValueError(f'unknown command: {command}')
+        return {'ok': True}
+
+    def call(self, fn):
+        # run fn where it is safe to touch the settings
+        with self.lock:
+            return fn()
+
+    def state(self):
+        return {'play': self.isPlaying(), 'noise': self.noise, 'duration': self.duration,
+                **{ k: int(getattr(self, k).get_value()) for k in SLIDERS },
+                'fade': self.fade, 'extras': self.extras, 'layers': self.layers, 'output_stats': self.player.stats()}
+
+    def apply(self, updates):
+        for name, value in updates.items():
+            if name in SLIDERS:
+                getattr(self, name).set_value(value)
+            else:
+                setattr(self, name, value)
+        self.refresh()
+
+
+# Stands in for a Gtk.Adjustment when running without a window
+class Value:
+    def __init__(self, value):
+        self.value = value
+
+    def get_value(self):
+        return self.value
+
+    def set_value(self, value):
+        self.value = value
+
+
+# Plays straight from the command line without ever importing GTK
+class Headless(SoxNoiseCore):
+    def __init__(self, args=[]):
+        self.parseArgs(args)
+        self.playing = True
+        for k in SLIDERS:
+            setattr(self, k, Value(getattr(self.pargs, k)))
+        self.extras = self.pargs.extras
+        self.fade = self.pargs.fade
+
+    def isPlaying(self):
+        return self.playing
+
+    def setPlaying(self, playing):
+        self.playing = playing
+        self.play()
+
+    def refresh(self):
+        self.update()
+
+    def resetSettings(self, pargs):
+        self.noise = pargs.noise
+        self.duration = pargs.duration
+        self.apply({k: getattr(pargs, k) for k in CONTROLS})
+
+    def loadSettings(self, filename):
+        pargs = self.presetArgs(filename)
+        self.layers = self.parseLayers(filename, pargs)
+        self.resetSettings(pargs)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.onDestroy)
+        signal.signal(signal.SIGTERM, self.onDestroy)
+        self.params = Params.fromApp(self)
+        self.saveSound()
+        self.play()
+        # until the output goes away, or forever while it can be controlled
+        while self.control_server or self.player.thread.is_alive():
+            time.sleep(.2)
+        self.onDestroy()
+
+
+class SoxNoise(SoxNoiseCore):
+    def __init__(self, args=[], app=None):
+        started = time.monotonic()
+        self.builder = Gtk.Builder()
+        self.builder.add_from_file(os.path.join(os.path.dirname(__file__), "main.ui"))
+        self.builder.connect_signals(self)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, self.onDestroy)
+
+        self.window = self.builder.get_object('main-window')
+        self.main_box = self.builder.get_object('main-box')
+        self.play_button = self.builder.get_object('play-button')
+        self.spec_button = self.builder.get_object('spec-button')
+        self.spec_image = self.builder.get_object('spec-image')
+        self.spec_height = None
+        self.preset_combo = self.builder.get_object('preset-combo')
+        self.listing = False
+        self.band_center = self.builder.get_object('adj-band-center')
+        self.band_width = self.builder.get_object('adj-band-width')
+        self.tremolo_speed = self.builder.get_object('adj-tremolo-speed')
+        self.tremolo_depth = self.builder.get_object('adj-tremolo-depth')
+        self.effects = self.builder.get_object('effects-expander')
+        self.lowpass = self.builder.get_object('adj-lowpass')
+        self.reverb = self.builder.get_object('adj-reverb')
+        self.volume = self.builder.get_object('adj-volume')
+        self.menu = self.builder.get_object('popover-menu')
+        if app:  self.window.set_application(app)
+        built = profiler.since(started)
+        self.parseArgs(args)
+        profiler.event('ui', ms=built)
+        self.analyzer = None
+        self.scheduler = Scheduler(GLib.timeout_add)
+        self.last_sound_fname = 'noise.ogg'
+        self.last_config_fname = 'noise.sxn'
+        self.resetSettings(self.pargs)
         if self.pargs.effects:
             self.effects.set_expanded(True)
         if not self.pargs.hide:
@@ -133,13 +1538,38 @@ class SoxNoise:
         Gtk.StyleContext().add_provider_for_screen(Gdk.Screen.get_default(),
             css_provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
 
-    def parseConfig(self, cpath):
-        config = configparser.ConfigParser()
-        config.read([cpath])
-        copts = { k.replace('-', '_'): v
-                  for k, v in config.items(config.sections()[0]) }
-        if 'extras' in copts:  copts['extras'] = copts['extras'].split(' ')
-        return copts
+    def isPlaying(self):
+        return self.play_button.get_active()
+
+    def setPlaying(self, playing):
+        self.play_button.set_active(playing)
+
+    def schedule(self, kind, fn):
+        self.scheduler.submit(kind, fn)
+
+    def play(self, button=None):
+        super().play(button)
+        self.liveSpectrum()
+
+    def refresh(self):
+        self.builder.get_object(f'btn-noise-{self.noise}').set_active(True)
+        self.needs_update = True
+        self.doneAdjusting()
+
+    def call(self, fn):
+        # GTK may only be used from the main loop
+        done, result, error = threading.Event(), [], []
+        def run():
+            try:
+                result.append(fn())
+            except Exception as e:  # raised again in the calling thread
+                error.append(e)
+            finally:
+                done.set()
+        GLib.idle_add(run)
+        done.wait()
+        if error:  raise error[0]
+        return result[0] if result else None
 
     def resetSettings(self, pargs=None):
         if not pargs or not isinstance(pargs, argparse.Namespace):
@@ -158,10 +1588,6 @@ class SoxNoise:
         self.builder.get_object(f'btn-noise-{pargs.noise}').emit('clicked')
         self.doneAdjusting()
 
-    def onDestroy(self, *args):
-        if getattr(self, 'subp', False):  self.subp.kill()
-        sys.exit()
-
     def onKeyPress(self, widget, event):
         # TODO: configurable keybinds
         # play/pause on space
@@ -181,6 +1607,9 @@ class SoxNoise:
             # load on Ctrl+O
             elif event.keyval in [Gdk.KEY_o, Gdk.KEY_O]:
                 self.loadSettings()
+            # presets on Ctrl+1..9
+            elif Gdk.KEY_1 <= event.keyval <= Gdk.KEY_9:
+                self.choosePreset(number=event.keyval - Gdk.KEY_0)
             # save on Ctrl+S
             elif event.keyval in [Gdk.KEY_s, Gdk.KEY_S]:
                 if event.state & Gdk.ModifierType.SHIFT_MASK:
@@ -195,18 +1624,43 @@ class SoxNoise:
     def setNoise(self, button):
         if (button.get_active()):
             self.noise = button.get_label().lower()
-            self.play()  # resume playback
-            self.saveSound()
-            self.showSpectrogram()
+            self.update()
 
     def doneAdjusting(self, widget=None, event=None):
         # resume playback with new settings
         if self.needs_update:
-            self.saveSound()
             self.needs_update = False
-            if not widget or widget.get_name() in ['band_width', 'band_center', 'lowpass']:
-                self.showSpectrogram()
-            if self.subp:  self.play()
+            self.update()
+
+    def refreshPresets(self, widget=None):
+        # numbered like their Ctrl+N shortcut
+        self.library.scan()
+        self.listing = True
+        self.preset_combo.remove_all()
+        for i, path in enumerate(self.library.paths(), 1):
+            name = os.path.splitext(os.path.basename(path))[0]
+            self.preset_combo.append(path, f'{i}. {name}' if i <= 9 else name)
+        self.preset_combo.set_active_id(self.preset)
+        self.listing = False
+
+    def choosePreset(self, combo=None, number=None):
+        if self.listing:  return
+        self.library.scan()
+        path = combo.get_active_id() if combo else self.library.find(str(number))
+        if not path or path == self.preset:  return
+        self.closeMenu()
+        self.player.requested = time.monotonic()
+        self.usePreset(path)
+
+    def warmSpectrogram(self, s):
+        # from the preset worker: fills sox_noise_numpy.spectrogram()'s cache
+        if not self.spec_height or s['extras']:  return
+        try:
+            import sox_noise_numpy
+        except ImportError:
+            return
+        sox_noise_numpy.spectrogram(s['noise'], s['band_center'], s['band_width'], s['lowpass'],
+                                    SPEC_WIDTH, self.spec_height)
 
     def closeMenu(self, widget=None):
         self.menu.popdown()
@@ -226,38 +1680,36 @@ class SoxNoise:
             'spectrogram': self.spec_button.get_active(),
             'output': self.pargs.output,
             'duration': self.duration,
+            'endless': self.pargs.endless,
             'fade': self.fade,
+            'crossfade': self.player.crossfade,
+            'period': self.pargs.period,
+            'buffer': self.pargs.buffer,
+            'latency': self.pargs.latency,
+            'engine': self.pargs.engine,
             'tray': self.pargs.tray,
             'hide': self.pargs.hide,
             'extras': ' '.join(self.extras or []),
+            'cache_size': self.pargs.cache_size,
         }
         config.read_dict({'sox-noise': {
-            k:v for k,v in args.items() if v and v != getattr(self.defaults, k) }})
+            k:v for k,v in args.items() if v and v != getattr(self.defaults, k) },
+            **{ f'layer{i}': {
+                k: ' '.join(v) if k == 'extras' else v for k,v in layer.items()
+                if v is not None and v != getattr(self.defaults, k) and k not in ['duration', 'fade'] }
+                for i, layer in enumerate(self.layers, 1) }})
         with open(filename, 'w') as configfile:
             config.write(configfile)
 
-    def loadSettings(self, widget=None):
-        filename = self.dialog('Load Settings', conf=True, filename=self.last_config_fname)
-        if not filename:  return
+    def loadSettings(self, widget=None, filename=None):
+        if not filename:
+            filename = self.dialog('Load Settings', conf=True, filename=self.last_config_fname)
+            if not filename:  return
         self.last_config_fname = filename
-        copts = self.parseConfig(filename)
-        self.parser.set_defaults(**vars(self.defaults))
-        self.parser.set_defaults(**copts)
-        pargs = self.parser.parse_args([])
+        pargs = self.presetArgs(filename)
+        self.layers = self.parseLayers(filename, pargs)
         self.resetSettings(pargs)
 
-    def saveSound(self, widget=None):
-        if widget:  # button clicked
-            filename = self.dialog('Save Sound', audio=True, save=True, filename=self.last_sound_fname)
-            if not filename:  return
-        elif self.save:
-            filename = self.save
-        else:  return
-        self.last_sound_fname = filename
-        args = self.getArgs([filename], repeat=False)
-        # print('\n save===>', ' '.join(args), file=sys.stderr)
-        Popen(args)
-
     # show FileChooserDialog and return filename
     def dialog(self, title, audio=False, conf=False, save=False, filename=None):
         dialog = Gtk.FileChooserDialog(title=title, parent=self.window, action=Gtk.FileChooserAction.SAVE if save else Gtk.FileChooserAction.OPEN)
@@ -292,6 +1744,7 @@ class SoxNoise:
         return selected
 
     def showSpectrogram(self, widget=None, event=None):
+        self.liveSpectrum()
         if not self.spec_button.get_active():
             return self.spec_image.hide()
 
@@ -300,65 +1753,192 @@ class SoxNoise:
         if widget == self.effects:
             # HACK: show spectgrogram after resizing
             return GLib.timeout_add(50, self.showSpectrogram)
+        if self.analyzer:  return  # already showing what plays
+        self.scheduler.submit('spectrogram', self.renderSpectrogram)
 
+    def liveSpectrum(self, *args):
+        # the analyzer only runs while playing into a visible spectrogram
+        height = self.main_box.get_allocation().height - 9
+        gdk_window = self.window.get_window()
+        visible = self.window.get_visible() and not (
+            gdk_window and gdk_window.get_state() & Gdk.WindowState.ICONIFIED)
+        wanted = (self.pargs.analyzer_fps > 0 and self.spec_button.get_active() and visible
+                  and self.player.playing and height >= 2)
+        if self.analyzer and (not wanted or self.analyzer.height != height):
+            self.player.tap = None
+            self.analyzer.stop()
+            self.analyzer = None
+            if self.spec_button.get_active() and visible:
+                self.scheduler.submit('spectrogram', self.renderSpectrogram)
+        if wanted and not self.analyzer:
+            try:
+                self.analyzer = Analyzer(self.paintSpectrum, height, self.pargs.analyzer_fps,
+                                         self.pargs.analyzer_budget)
+            except ImportError as e:
+                print('ANALYZER ERROR:', e, file=sys.stderr)
+                self.pargs.analyzer_fps = 0
+                return False
+            self.player.tap = self.analyzer.ring.write
+        return False
+
+    def paintSpectrum(self, analyzer, rgb):
+        # called from the analyzer's thread
+        def paint():
+            if analyzer is self.analyzer:
+                self.setSpectrogram(GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(rgb),
+                    GdkPixbuf.Colorspace.RGB, False, 8, SPEC_WIDTH, analyzer.height, SPEC_WIDTH * 3))
+            analyzer.painting = False
+            return False
+        GLib.idle_add(paint)
+
+    def renderSpectrogram(self):
         # NOTE: -y values should be "one more than a multiple of two" for optimal performance. Use -Y to truncate
         # MAGIC: height - 9 happens to remove padding, etc for me (87 w/o -r)
         height = self.main_box.get_allocation().height - 9
+        if height < 2:  return
+        self.spec_height = height
+        if not self.extras:  # extras only work through sox
+            try:
+                import sox_noise_numpy
+            except ImportError:
+                pass
+            else:
+                started = time.monotonic()
+                data = sox_noise_numpy.spectrogram(self.noise, self.band_center.get_value(),
+                    self.band_width.get_value(), self.lowpass.get_value(), SPEC_WIDTH, height)
+                profiler.event('spectrogram', engine='numpy', height=height, ms=profiler.since(started))
+                return self.setSpectrogram(GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+                    GdkPixbuf.Colorspace.RGB, False, 8, SPEC_WIDTH, height, SPEC_WIDTH * 3))
         args = self.getArgs(['--null'], full=False) + [
-            'spectrogram', '-o-', '-x200', f'-y{height}','-r']
+            'spectrogram', '-o-', f'-x{SPEC_WIDTH}', f'-y{height}','-r']
         # print('\n spec===>', ' '.join(args), file=sys.stderr)
-        spec = GLib.spawn_async(args, flags=GLib.SpawnFlags.SEARCH_PATH, standard_output=True)
-        GLib.io_add_watch(spec[2], GLib.IO_IN, self.specDone)
-
-    def specDone(self, fd, x):
-        with os.fdopen(fd, "rb") as spec:
-            loader = GdkPixbuf.PixbufLoader()
-            loader.write(spec.read())
-            loader.close()
-            self.spec_image.set_from_pixbuf(loader.get_pixbuf())
-            self.spec_image.show()
-
-    def getArgs(self, output, full=True, repeat=True):
-        vol = self.volume.get_value()
-        return ['sox', f'-c{2 if full else 1}', '--null', *output,
-            'synth', f'0:{self.duration if full else 1}', f'{self.noise}noise',
-            'band', '-n', str(self.band_center.get_value()), str(self.band_width.get_value())] + ([
-            'lowpass', '-1', str(self.lowpass.get_value())] if self.lowpass.get_value() else []) + ([
-            'tremolo', str(self.tremolo_speed.get_value()/self.duration), str(self.tremolo_depth.get_value()),
-            'reverb', str(self.reverb.get_value())] + ([
-            'vol', str(vol/100)] if vol <= 100 else ['gain', str(vol-100)]) + [
-            'fade', 'q', str(self.fade), f'0:{self.duration}', str(self.fade)] if full else []) + (
-            self.extras if self.extras else []) + ([
-            'repeat', '-'] if full and repeat else [])
+        return self.supervisor.spawn('spectrogram', args, stdout=PIPE, on_start=lambda spec:
+            GLib.io_add_watch(spec.stdout, GLib.IO_IN | GLib.IO_HUP, self.specDone, spec))
+
+    def specDone(self, stdout, x, spec):
+        with stdout:
+            data = stdout.read()
+        if spec.wait() != 0:  return False  # cancelled by a newer one
+        started = time.monotonic()
+        loader = GdkPixbuf.PixbufLoader()
+        loader.write(data)
+        loader.close()
+        profiler.event('spectrogram', engine='sox', decode_ms=profiler.since(started),
+                       ms=(time.monotonic() - spec.started) * 1000)
+        self.setSpectrogram(loader.get_pixbuf())
+        return False
+
+    def setSpectrogram(self, pixbuf):
+        self.spec_image.set_from_pixbuf(pixbuf)
+        self.spec_image.show()
+
+
+# Renders one preset in a worker process
+def renderPreset(job):
+    started = time.monotonic()
+    if job['engine'] == 'numpy':
+        import sox_noise_numpy
+        engine = sox_noise_numpy.Engine(job['settings'], RATE, CHANNELS, layers=job['layers'])
+        sink = Popen(['sox', *RAW, '-', job['output']], stdin=PIPE, stderr=DEVNULL)
+        for _ in range(-(-job['duration'] * RATE // engine.block)):
+            sink.stdin.write(engine.read())
+        sink.stdin.close()
+        returncode = sink.wait()
+    else:
+        returncode = Popen(job['args'], stderr=DEVNULL).wait()
+    return returncode, time.monotonic() - started
 
-    def play(self, button=None):
-        if self.subp:  self.subp.kill()
-        if self.play_button.get_active():
-            args = self.getArgs(self.output)
-            print('\n ===>', ' '.join(args), file=sys.stderr)
-            self.subp = Popen(args)
+
+def batch(args=None):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    parser = argparse.ArgumentParser(description='Render .sxn presets to audio files in parallel.')
+    parser.add_argument('presets',     nargs='+',           help='.sxn files or glob patterns')
+    parser.add_argument('--outdir',    '-o', default='.',   help='Directory for the rendered files')
+    parser.add_argument('--format',    default='ogg',       help='Audio file extension (default: ogg)')
+    parser.add_argument('--jobs',      '-j', type=int, default=os.cpu_count(), help='Parallel renders (default: number of cores)')
+    parser.add_argument('--force',     action='store_true', help='Render even if the output is up to date')
+    pargs = parser.parse_args(sys.argv[1:] if args is None else args)
+
+    paths = sorted({p for pattern in pargs.presets for p in (glob.glob(pattern) or [pattern])})
+    os.makedirs(pargs.outdir, exist_ok=True)
+    jobs, skipped, failed = [], 0, 0
+    app = Headless(['--cache-size=0', '--output=sox', '--warm=0'])
+    for path in paths:
+        if not os.path.isfile(path):
+            failed += 1
+            print(f' FAILED {path}: no such preset', file=sys.stderr)
+            continue
+        output = os.path.join(pargs.outdir, f'{os.path.splitext(os.path.basename(path))[0]}.{pargs.format}')
+        if not pargs.force and os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(path):
+            skipped += 1
+            continue
+        try:
+            preset = app.presetArgs(path)
+            params = Params.fromArgs(preset, app.parseLayers(path, preset))
+        except (ValueError, IndexError, configparser.Error) as e:
+            failed += 1
+            print(f' FAILED {path}: {e}', file=sys.stderr)
+            continue
+        jobs.append({'path': path, 'output': output, 'engine': 'sox' if params.sox_only else preset.engine, 'duration': params.duration,
+                     'settings': params.settings(), 'layers': [layer.settings() for layer in params.layers],
+                     'args': app.getArgs([output], repeat=False, params=params)})
+
+    started = time.monotonic()
+    rendered = audio = 0
+    with ProcessPoolExecutor(max(1, pargs.jobs)) as pool:
+        futures = {pool.submit(renderPreset, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            returncode, seconds = future.result()
+            if returncode:
+                failed += 1
+                print(f' FAILED {job["path"]}: exit {returncode}', file=sys.stderr)
+            else:
+                rendered += 1
+                audio += job['duration']
+                print(f' {job["output"]}: {job["duration"]}s in {seconds:.2f}s', file=sys.stderr)
+    wall = time.monotonic() - started
+    print(f'{rendered} rendered, {skipped} up to date, {failed} failed in {wall:.2f}s:'
+          f' {audio / wall if wall else 0:.1f}x realtime, {rendered / wall if wall else 0:.2f} files/s', file=sys.stderr)
+    return 1 if failed else 0
+
+
+def requireGtk():
+    global gi, Gtk, GLib, Gdk, Gio, GdkPixbuf
+    import gi
+    gi.require_version("Gtk", "3.0")
+    from gi.repository import Gtk, GLib, Gdk, Gio, GdkPixbuf
 
 
 # Integrates App with DE rich-features
-class SoxNoiseApp(Gtk.Application):
-    def __init__(self, win=None):
-        super().__init__(application_id='thann.sox-noise', flags=(
-            Gio.ApplicationFlags.NON_UNIQUE |
-            Gio.ApplicationFlags.HANDLES_OPEN
-        ))
+@lru_cache()
+def appClass():
+    requireGtk()
+    class SoxNoiseApp(Gtk.Application):
+        def __init__(self, win=None):
+            super().__init__(application_id='thann.sox-noise', flags=(
+                Gio.ApplicationFlags.NON_UNIQUE |
+                Gio.ApplicationFlags.HANDLES_OPEN
+            ))
+
+        def run(self, args):
+            # circumvent options parsing
+            self.args = args[1:]
+            super().run()
+
+        def do_activate(self, args=[]):
+            self.register()
+            self.app = SoxNoise(self.args, app=self)
 
-    def run(self, args):
-        # circumvent options parsing
-        self.args = args[1:]
-        super().run()
+        def do_open(self, files, n_files, hint):
+            if not getattr(self, 'app', None):  self.do_activate()
+            self.app.loadSettings(filename=files[0].get_path())
+    return SoxNoiseApp
 
-    def do_activate(self, args=[]):
-        self.register()
-        self.app = SoxNoise(self.args, app=self)
 
-    # TODO:
-    # def do_open(files, hint):
-    #     self.app.loadSettings(files)
+def __getattr__(name):
+    if name == 'SoxNoiseApp':  return appClass()
+    raise AttributeError(name)
 
 
 version = 'Unknown'
@@ -369,7 +1949,19 @@ if os.path.exists(vfilename):
         version = (ver.read() or version).strip()
 
 def start():
-    sys.exit(SoxNoiseApp().run(sys.argv))
+    # a hidden window without a tray icon can never be shown, so skip GTK;
+    # the config file can set either, so it is parsed first
+    options = SoxNoiseCore()
+    options.parseOptions(sys.argv[1:])
+    if options.pargs.headless or (options.pargs.hide and not options.pargs.tray):
+        headless()
+    sys.exit(appClass()().run(sys.argv))
+
+def headless():
+    sys.exit(Headless(sys.argv[1:]).run())
+
+def batchRender():
+    sys.exit(batch())
 
 if __name__ == '__main__':
     start()
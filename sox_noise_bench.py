@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Benchmarks for sox-noise, run with: python -m sox_noise_bench [bench] --json results.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import sox_noise
+from subprocess import Popen, PIPE, DEVNULL, run
+
+WAV_HEADER = 44
+NOISES = ['brown', 'pink', 'white', 'tpdf']
+COMBOS = {
+    'dry':     ['--reverb=0', '--tremolo-depth=0'],
+    'lowpass': ['--reverb=0', '--tremolo-depth=0', '--lowpass=300'],
+    'reverb':  ['--reverb=50', '--tremolo-depth=0'],
+    'tremolo': ['--reverb=0', '--tremolo-depth=50'],
+}
+TARGETS = ['null', 'file', 'pipe']
+SPEC_HEIGHT = 87
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def timed(fn, runs):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return median(times)
+
+
+def core(noise, combo, duration):
+    # the effect chain exactly as the app builds it
+    return sox_noise.Headless([noise, f'--duration={duration}', '--cache-size=0', '--output=sox', '--warm=0', *COMBOS[combo]])
+
+
+def importTime():
+    # seconds to import sox_noise in a fresh interpreter, and whether it pulled in GTK
+    out = run([sys.executable, '-c', 'import time, sys; t = time.perf_counter(); import sox_noise; '
+               'print(time.perf_counter() - t, "gi" in sys.modules)'],
+              stdout=PIPE, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return float(out[0]), out[1] == b'True'
+
+
+def firstAudio(args=[]):
+    # seconds from launching headless until the first audio bytes arrive on stdout
+    started = time.perf_counter()
+    proc = Popen([sys.executable, os.path.abspath(sox_noise.__file__),
+                  '--headless', '--output=wav', *args], stdout=PIPE, stderr=DEVNULL)
+    data = proc.stdout.read(WAV_HEADER + 1)
+    elapsed = time.perf_counter() - started
+    proc.terminate()
+    proc.wait()
+    if len(data) <= WAV_HEADER:  raise RuntimeError('no audio produced')
+    return elapsed
+
+
+def firstByte(args):
+    # seconds until a playback source produces its first byte
+    started = time.perf_counter()
+    proc = Popen(args, stdout=PIPE, stderr=DEVNULL)
+    proc.stdout.read(1)
+    elapsed = time.perf_counter() - started
+    proc.kill()
+    proc.wait()
+    return elapsed
+
+
+def render(sn, target, tmp):
+    if target == 'pipe':
+        proc = Popen(sn.getArgs([*sox_noise.RAW, '-'], repeat=False), stdout=PIPE, stderr=DEVNULL)
+        while proc.stdout.read(2**16):  pass
+        return proc.wait()
+    output = ['--null'] if target == 'null' else [os.path.join(tmp, 'render.sox')]
+    run(sn.getArgs(output, repeat=False), stderr=DEVNULL, check=True)
+
+
+def benchStartup(pargs, results):
+    imports = [importTime() for _ in range(pargs.runs)]
+    audio = median([firstAudio() for _ in range(pargs.runs)])
+    results.append({'bench': 'startup', 'import': median([t for t, _ in imports]),
+                    'gtk_imported': any(gtk for _, gtk in imports), 'first_audio': audio})
+    print(f'import: {results[-1]["import"]*1000:.1f}ms  first audio: {audio*1000:.1f}ms'
+          f'  (budget {pargs.budget:.0f}ms)', file=sys.stderr)
+    if results[-1]['gtk_imported']:
+        print('FAIL: importing sox_noise loaded GTK', file=sys.stderr)
+        return False
+    return audio * 1000 < pargs.budget
+
+
+def benchPlay(pargs, results):
+    for noise, combo, duration in matrix(pargs):
+        sn = core(noise, combo, duration)
+        seconds = median([firstByte(sn.getArgs([*sox_noise.RAW, '-'])) for _ in range(pargs.runs)])
+        results.append({'bench': 'play', 'noise': noise, 'combo': combo, 'duration': duration,
+                        'first_byte': seconds})
+        report(results[-1], seconds)
+    return True
+
+
+def benchRender(pargs, results):
+    with tempfile.TemporaryDirectory() as tmp:
+        for noise, combo, duration in matrix(pargs):
+            sn = core(noise, combo, duration)
+            for target in pargs.targets:
+                seconds = timed(lambda: render(sn, target, tmp), pargs.runs)
+                results.append({'bench': 'render', 'noise': noise, 'combo': combo, 'duration': duration,
+                                'target': target, 'seconds': seconds, 'realtime': duration / seconds})
+                report(results[-1], seconds)
+    return True
+
+
+def benchSpectrogram(pargs, results):
+    try:
+        import sox_noise_numpy
+    except ImportError:
+        sox_noise_numpy = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for noise, combo in dict.fromkeys((n, c) for n, c, _ in matrix(pargs)):
+            sn = core(noise, combo, 1)
+            args = sn.getArgs(['--null'], full=False) + [
+                'spectrogram', '-o', os.path.join(tmp, 'spec.png'), '-x200', f'-y{SPEC_HEIGHT}', '-r']
+            engines = {'sox': lambda: run(args, stderr=DEVNULL, check=True)}
+            if sox_noise_numpy:
+                def numpy():
+                    sox_noise_numpy.spectrogram.cache_clear()
+                    sox_noise_numpy.spectrogram(noise, sn.band_center.get_value(), sn.band_width.get_value(),
+                                                sn.lowpass.get_value(), 200, SPEC_HEIGHT)
+                engines['numpy'] = numpy
+            for engine, fn in engines.items():
+                seconds = timed(fn, pargs.runs)
+                results.append({'bench': 'spectrogram', 'engine': engine, 'noise': noise,
+                                'combo': combo, 'seconds': seconds})
+                report(results[-1], seconds)
+    return True
+
+
+def matrix(pargs):
+    return [(n, c, d) for n in pargs.noises for c in pargs.combos for d in pargs.durations]
+
+
+def report(result, seconds):
+    labels = ' '.join(str(v) for k, v in result.items() if isinstance(v, (str, int)) and k != 'bench')
+    print(f'{result["bench"]:>11} {labels}: {seconds*1000:.1f}ms', file=sys.stderr)
+
+
+BENCHES = {
+    'startup': benchStartup,
+    'play': benchPlay,
+    'render': benchRender,
+    'spectrogram': benchSpectrogram,
+}
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmarks for sox-noise.')
+    parser.add_argument('benches',     choices=[*BENCHES, 'all'], nargs='*', default=['startup'])
+    parser.add_argument('--runs',      type=int,   default=3,   help='Repetitions per measurement (median is kept)')
+    parser.add_argument('--budget',    type=float, default=100, help='Fail when startup exceeds this (ms)')
+    parser.add_argument('--noises',    nargs='+', choices=NOISES, default=NOISES)
+    parser.add_argument('--combos',    nargs='+', choices=COMBOS, default=list(COMBOS))
+    parser.add_argument('--durations', nargs='+', type=int, default=[10, 60, 300], help='Loop lengths (s)')
+    parser.add_argument('--targets',   nargs='+', choices=TARGETS, default=TARGETS, help='Where renders go')
+    parser.add_argument('--json',      help='Write results to this file (default: stdout)')
+    pargs = parser.parse_args(args)
+    benches = list(BENCHES) if 'all' in pargs.benches else pargs.benches
+
+    # keep the user's config and cache out of it
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['XDG_CONFIG_HOME'] = os.environ['XDG_CACHE_HOME'] = tmp
+        results = []
+        ok = all([BENCHES[bench](pargs, results) for bench in benches])
+    out = json.dumps({'version': sox_noise.version, 'results': results}, indent=2)
+    if pargs.json:
+        with open(pargs.json, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
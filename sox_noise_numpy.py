@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# In-process noise synthesis with NumPy, an alternative to the sox pipeline.
+# Noise is shaped in the frequency domain (color, band, lowpass) and
+# overlap-added block by block, so settings can change between blocks.
+
+import sys
+import numpy as np
+from functools import lru_cache
+from subprocess import run, PIPE
+
+LEVEL = 0.18  # rms of the shaped noise before volume (about -15dBFS)
+
+
+# Layers sharing tremolo and reverb settings are mixed in the frequency
+# domain: independent noises add up in power, so each such group costs one
+# inverse FFT and one reverb no matter how many layers it holds.
+class Engine:
+    def __init__(self, settings, rate=48000, channels=2, block=1024, seed=None, layers=()):
+        self.rate = rate
+        self.channels = channels
+        self.block = block
+        self.rng = np.random.default_rng(seed)
+        self.window = np.sqrt(np.hanning(2 * block + 1)[:-1])  # periodic, sums to 1 squared
+        self.freqs = np.fft.rfftfreq(2 * block, 1 / rate)
+        self.position = 0  # samples generated, keeps the tremolo phase continuous
+        self.settings = {}
+        self.layers = list(layers)
+        self.groups = {}
+        self.update(settings)
+
+    def update(self, settings, layers=None):
+        # takes effect from the next block, regrouped by the thread calling synth()
+        self.settings = {**self.settings, **settings}
+        if layers is not None:  self.layers = list(layers)
+        self.changed = True
+
+    def regroup(self):
+        layers, members = [self.settings, *self.layers], {}
+        for i, layer in enumerate(layers):
+            key = (layer['tremolo_speed'] / layer['duration'], layer['tremolo_depth'], layer['reverb'])
+            members.setdefault(key, []).append(i)
+        groups = {}
+        for key, indexes in members.items():
+            groups[key] = self.groups.get(key) or Group(*key, self)
+            groups[key].shape([layers[i] for i in indexes])
+        # groups that survive keep their overlap and reverb state, a retired
+        # one hands it to where its first layer went, so nothing drops out
+        heirs = {i: key for key, indexes in members.items() for i in indexes}
+        for key, group in self.groups.items():
+            heir = groups.get(heirs.get(group.first))
+            if key not in groups and heir:  heir.inherit(group)
+        for key, indexes in members.items():
+            groups[key].first = indexes[0]
+        self.groups = groups
+
+    def synth(self):
+        # float block of shape (channels, block)
+        if self.changed:
+            self.changed = False
+            self.regroup()
+        out = sum(group.synth(self) for group in self.groups.values())
+        self.position += self.block
+        return out
+
+    def read(self):
+        # interleaved signed 16bit PCM, like sox -traw -esigned -b16
+        out = np.clip(self.synth().T * 32768, -32768, 32767)
+        return out.astype('<i2').tobytes()
+
+
+class Group:
+    def __init__(self, speed, depth, reverb, engine):
+        self.speed = speed
+        self.depth = depth / 100
+        self.tail = np.zeros((engine.channels, engine.block))
+        self.combs = Reverb(reverb, engine.channels, engine.block)
+        self.freqs = engine.freqs
+        self.block = engine.block
+        self.first = None  # index of the first layer in it
+
+    def inherit(self, other):
+        self.tail = self.tail + other.tail
+        self.combs.inherit(other.combs)
+
+    def shape(self, layers):
+        power = 0
+        for layer in layers:
+            mag = shape(self.freqs, layer)
+            vol = layer['volume']
+            gain = vol/100 if vol <= 100 else 10**((vol-100) / 20)
+            power = power + (mag * gain * LEVEL * self.block / np.sqrt(np.sum(mag**2)))**2
+        self.magnitude = np.sqrt(power)
+
+    def synth(self, engine):
+        n = 2 * self.block
+        spectrum = engine.rng.standard_normal((2, engine.channels, n // 2 + 1))
+        frames = np.fft.irfft((spectrum[0] + 1j * spectrum[1]) * self.magnitude, n) * engine.window
+        out = self.tail + frames[:, :self.block]
+        self.tail = frames[:, self.block:]
+        out = self.combs.process(out)
+        return out * self.tremolo(engine.position, self.block, engine.rate)
+
+    def tremolo(self, start, length, rate):
+        if not self.speed or not self.depth:  return 1
+        t = (start + np.arange(length)) / rate
+        return 1 - self.depth * (1 - np.sin(2 * np.pi * self.speed * t)) / 2
+
+
+def shape(freqs, settings):
+    f = np.maximum(freqs, freqs[1])  # avoid dividing by DC
+    noise = settings['noise']
+    if noise == 'pink':
+        mag = 1 / np.sqrt(f)
+    elif noise == 'brown':
+        mag = 1 / f
+    else:  # white and tpdf have a flat spectrum, only the pdf differs
+        mag = np.ones_like(f)
+    # 2-pole resonator like sox's 'band -n'
+    mag = mag / np.sqrt(1 + ((freqs - settings['band_center']) / (settings['band_width'] / 2))**2)
+    if settings['lowpass']:  # 1-pole like sox's 'lowpass -1'
+        mag = mag / np.sqrt(1 + (freqs / settings['lowpass'])**2)
+    mag[0] = 0
+    return mag
+
+
+# Parallel feedback combs. Every delay is at least one block long, so each
+# block only depends on previous output and can be computed vectorized.
+class Reverb:
+    DELAYS = [1.05, 1.13, 1.22, 1.31]  # in blocks
+
+    def __init__(self, amount, channels, block):
+        self.wet = amount / 100 * 0.6
+        self.feedback = 0.7 + 0.25 * amount / 100
+        self.block = block
+        # offset the right channel's delays to decorrelate the stereo image
+        self.delays = [[int(block * d * (1 + 0.03 * c)) for d in self.DELAYS] for c in range(channels)]
+        self.history = [[np.zeros(d) for d in ds] for ds in self.delays]
+
+    def inherit(self, other):
+        # the delays only depend on the block size, so the history carries over
+        self.history = [[h + o for h, o in zip(hs, os)] for hs, os in zip(self.history, other.history)]
+
+    def process(self, block):
+        if not self.wet:  return block
+        out = np.empty_like(block)
+        for c, x in enumerate(block):
+            wet = np.zeros(self.block)
+            for i, hist in enumerate(self.history[c]):
+                y = x + self.feedback * hist[:self.block]
+                self.history[c][i] = np.concatenate((hist[self.block:], y))
+                wet += y
+            out[c] = x + self.wet * (1 - self.feedback) * wet
+        return out
+
+
+# Colors from silence to full scale, like sox's spectrogram
+PALETTE = np.array([
+    [0, 0, 0], [40, 0, 100], [140, 0, 140], [230, 20, 30], [255, 160, 0], [255, 255, 120], [255, 255, 255],
+], dtype=float)
+
+
+# Raw RGB rows (top row = highest frequency) of a 1 second mono excerpt
+# that went through the filters, like 'sox ... spectrogram -r'
+@lru_cache(maxsize=128)
+def spectrogram(noise, band_center, band_width, lowpass, width, height, rate=48000, floor=-120):
+    settings = dict(noise=noise, band_center=band_center, band_width=band_width, lowpass=lowpass,
+                    reverb=0, tremolo_speed=0, tremolo_depth=0, volume=100, duration=1)
+    size = 2 * (height - 1)  # rfft size giving one bin per row
+    engine = Engine(settings, rate=rate, channels=1, block=1024, seed=0)
+    x = np.concatenate([engine.synth()[0] for _ in range(-(-(rate + size) // engine.block))])
+    window = np.hanning(size)
+    starts = np.linspace(0, rate, width).astype(int)
+    frames = x[starts[:, None] + np.arange(size)] * window
+    db = 20 * np.log10(2 * np.abs(np.fft.rfft(frames)) / window.sum() + 1e-12)
+    return np.ascontiguousarray(colors(db, floor).transpose(1, 0, 2)[::-1]).tobytes()
+
+
+def colors(db, floor):
+    level = np.clip(1 - db / floor, 0, 1) * (len(PALETTE) - 1)
+    low = np.minimum(level.astype(int), len(PALETTE) - 2)
+    frac = (level - low)[..., None]
+    return (PALETTE[low] * (1 - frac) + PALETTE[low + 1] * frac).astype(np.uint8)
+
+
+# Scrolling spectrogram of live 16bit PCM, rows like spectrogram()'s. Each
+# push() only transforms the audio it is given, averaging every full window
+# into one new column.
+class Waterfall:
+    def __init__(self, width, height, channels=2, floor=-120):
+        self.image = np.zeros((height, width, 3), np.uint8)
+        self.size = 2 * (height - 1)  # rfft size giving one bin per row
+        self.window = np.hanning(self.size)
+        self.channels = channels
+        self.floor = floor
+
+    def push(self, pcm):
+        # raw RGB of the whole image, or None if pcm is shorter than a window
+        x = np.frombuffer(pcm, '<i2').reshape(-1, self.channels).mean(axis=1) / 32768
+        n = len(x) // self.size
+        if not n:  return None
+        frames = x[-n * self.size:].reshape(n, self.size) * self.window
+        power = np.mean(np.abs(np.fft.rfft(frames))**2, axis=0)
+        db = 10 * np.log10(4 * power / self.window.sum()**2 + 1e-24)
+        self.image[:, :-1] = self.image[:, 1:]
+        self.image[:, -1] = colors(db, self.floor)[::-1]
+        return self.image.tobytes()
+
+
+def spectrum(pcm, channels, size=4096):
+    # averaged, normalized power spectrum in dB of interleaved 16bit PCM
+    x = np.frombuffer(pcm, '<i2').reshape(-1, channels)[:, 0] / 32768
+    frames = x[:len(x) // size * size].reshape(-1, size) * np.hanning(size)
+    power = np.mean(np.abs(np.fft.rfft(frames))**2, axis=0)[1:]
+    return 10 * np.log10(power / power.sum() + 1e-20)
+
+
+# Compare the engine's spectra against sox for each color
+def parity(seconds=4, rate=48000, tolerance=3):
+    failed = False
+    for noise in ['brown', 'pink', 'white', 'tpdf']:
+        settings = dict(noise=noise, band_center=500, band_width=500, lowpass=0, reverb=0,
+                        tremolo_speed=0, tremolo_depth=0, volume=100, duration=60)
+        engine = Engine(settings, rate=rate, seed=0)
+        pcm = b''.join(engine.read() for _ in range(seconds * rate // engine.block))
+        sox = run(['sox', '-c2', '--null', '-traw', f'-r{rate}', '-esigned', '-b16', '-c2', '-',
+                   'synth', f'0:{seconds}', f'{noise}noise', 'band', '-n', '500', '500'],
+                  stdout=PIPE, check=True).stdout
+        ours, theirs = spectrum(pcm, 2), spectrum(sox, 2)
+        # compare where there is meaningful energy: within 40dB of the peak
+        mask = theirs > theirs.max() - 40
+        error = np.sqrt(np.mean((ours[mask] - theirs[mask])**2))
+        failed |= error > tolerance
+        print(f'{noise:>6}: {error:.2f}dB rms deviation', file=sys.stderr)
+    return not failed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if parity() else 1)